@@ -0,0 +1,54 @@
+"""Print a graphrest SamplingProfiler aggregate saved by save().
+
+Usage: python graphprofile.py FILENAME [--top N]
+
+This module doesn't import graphrest (and therefore config.py), so that saved
+profiles can be examined on any machine.
+"""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import argparse
+import json
+import sys
+
+# timing phases in display order; same as graphrest.CallTimer.PHASES + total
+PHASES = ('token', 'serialize', 'connect', 'ttfb', 'download', 'decode',
+          'total')
+
+def print_profile(report, top=10, file=None):
+    """Print a SamplingProfiler aggregate (as returned by report() or saved
+    by save()): average phase timings and hottest frames for each endpoint,
+    slowest endpoints first."""
+    file = file or sys.stdout
+    endpoints = sorted(report.items(), reverse=True,
+                       key=lambda item: item[1]['timings'].get('total', 0.0))
+    for endpoint, stats in endpoints:
+        calls = stats['calls'] or 1
+        print(f"{endpoint}  calls={stats['calls']} "
+              f"sampled={stats['sampled_calls']}", file=file)
+        averages = '  '.join(
+            f"{phase}={1000 * stats['timings'].get(phase, 0.0) / calls:.1f}ms"
+            for phase in PHASES)
+        print(f'  avg: {averages}', file=file)
+        if stats['samples']:
+            print(f"  hot frames ({stats['samples']} samples):"
+                  '   self%  total%', file=file)
+            frames = sorted(stats['frames'].items(), key=lambda item:
+                            (stats['leaves'].get(item[0], 0), item[1]),
+                            reverse=True)
+            for name, count in frames[:top]:
+                leaf = stats['leaves'].get(name, 0)
+                print(f"    {100 * leaf / stats['samples']:5.1f}  "
+                      f"{100 * count / stats['samples']:6.1f}  {name}",
+                      file=file)
+        print(file=file)
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='print a graphrest SamplingProfiler aggregate')
+    PARSER.add_argument('filename')
+    PARSER.add_argument('--top', type=int, default=10,
+                        help='number of hot frames to show per endpoint')
+    ARGS = PARSER.parse_args()
+    with open(ARGS.filename) as FHANDLE:
+        print_profile(json.load(FHANDLE), top=ARGS.top)
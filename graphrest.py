@@ -1,11 +1,27 @@
 """Sample Microsoft Graph authentication library."""
 # Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
 # See LICENSE in the project root for license information.
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import email.utils
+import gzip
+import http.cookiejar
+import io
+import itertools
 import json
 import os
+import random
+import re
+import sys
+import threading
 import time
 import urllib.parse
 import urllib3
+import urllib3.connection
+import urllib3.connectionpool
 import uuid
 
 import requests
@@ -17,6 +33,608 @@ import config
 # Disable warnings to allow use of non-HTTPS for local dev/test.
 urllib3.disable_warnings()
 
+# Per-thread accumulator for connection setup time (DNS, TCP connect and TLS
+# handshake), written by the timed connection classes below and read by
+# GraphSession.http_request().
+CONNECT_TIMING = threading.local()
+
+class TimedConnection(object):
+    """Mixin for urllib3 connection classes that adds the time spent in
+    connect() to CONNECT_TIMING.seconds for the current thread."""
+
+    def connect(self):
+        """Open the connection, timing DNS lookup, connect and TLS handshake."""
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            CONNECT_TIMING.seconds = (getattr(CONNECT_TIMING, 'seconds', 0.0)
+                                      + time.perf_counter() - start)
+
+class TimedHTTPConnection(TimedConnection, urllib3.connection.HTTPConnection):
+    """HTTP connection with connect() timing."""
+
+class TimedHTTPSConnection(TimedConnection, urllib3.connection.HTTPSConnection):
+    """HTTPS connection with connect() timing."""
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    """HTTP connection pool that uses TimedHTTPConnection."""
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    """HTTPS connection pool that uses TimedHTTPSConnection."""
+    ConnectionCls = TimedHTTPSConnection
+
+class TimingAdapter(requests.adapters.HTTPAdapter):
+    """Requests transport adapter whose connection pools measure connection
+    setup time (see CONNECT_TIMING)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create the pool manager, using the timed connection pools."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+def timing_session():
+    """Return a Requests session that pools connections and measures
+    connection setup time.
+
+    The session rejects all cookies, so that sharing it (across tenants and
+    users, for example) shares only connections and not client state.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(
+        http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('https://', TimingAdapter())
+    session.mount('http://', TimingAdapter())
+    return session
+
+class AuthorityRegistry(object):
+    """Registry of Azure AD authorities for multi-tenant applications.
+
+    Resolves each tenant's OpenID Connect metadata document
+    (.well-known/openid-configuration) and caches it for ttl seconds. A single
+    Requests session is shared by all tenants, so connections to the login
+    host are pooled. Discovery never blocks a login: metadata is fetched and
+    refreshed on a background thread, and until a tenant's metadata has been
+    retrieved, its endpoints are derived from the standard v2.0 endpoint paths
+    in config.py. Expired metadata continues to be used for up to grace
+    seconds while it is refreshed; after that, the config.py paths are used
+    again until a refresh succeeds. Failed discoveries are reported with a
+    warning and retried with exponential backoff.
+
+    A registry can be shared by any number of GraphSession instances, via the
+    authority_registry argument.
+    """
+
+    def __init__(self, *, login_host=None, ttl=86400, refresh_ahead=3600,
+                 grace=86400, timeout=10, retry_interval=30, max_workers=2):
+        """Initialize a registry.
+
+        login_host = base URL of the login host; defaults to the scheme and
+                     host of config.AUTHORITY_URL
+        ttl = number of seconds that cached metadata is considered valid
+        refresh_ahead = cached metadata is refreshed in the background once it
+                        is within this many seconds of expiring
+        grace = number of seconds past ttl that expired metadata may still be
+                used, if it can't be refreshed
+        timeout = timeout in seconds for discovery requests
+        retry_interval = seconds to wait before retrying a failed discovery;
+                         doubled after each consecutive failure, up to ttl
+        max_workers = number of background discovery threads
+        """
+        if not login_host:
+            parsed = urllib.parse.urlparse(config.AUTHORITY_URL)
+            login_host = f'{parsed.scheme}://{parsed.netloc}'
+        self.login_host = login_host.rstrip('/')
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.grace = grace
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.session = timing_session()
+        self.lock = threading.Lock()
+        self.metadata = {} # tenant -> (metadata dict, time.time() fetched)
+        self.pending = set() # tenants with a discovery request in flight
+        self.failures = {} # tenant -> (time.time() of last failure, count)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __repr__(self):
+        """Return string representation of class instance."""
+        return (f'<AuthorityRegistry(login_host={self.login_host}, '
+                f'tenants={len(self.metadata)})>')
+
+    def authority_url(self, tenant):
+        """Return the authority URL for a tenant (GUID, domain name,
+        'common', 'organizations' or 'consumers')."""
+        return f'{self.login_host}/{tenant}'
+
+    def discover(self, tenant):
+        """Retrieve and cache a tenant's OpenID Connect metadata.
+
+        This call blocks; endpoints() and prefetch() use it from background
+        threads. Returns the metadata dictionary. If the request fails, a
+        warning is printed, the failure is recorded for retry backoff, and
+        the exception is re-raised.
+        """
+        try:
+            try:
+                response = self.session.get(self.discovery_url(tenant),
+                                            timeout=self.timeout)
+                response.raise_for_status()
+                metadata = response.json()
+            except (requests.exceptions.RequestException, ValueError) as err:
+                with self.lock:
+                    count = self.failures.get(tenant, (0, 0))[1] + 1
+                    self.failures[tenant] = (time.time(), count)
+                print(f'WARNING: OpenID discovery for tenant "{tenant}" '
+                      f'failed ({count} in a row): {err}')
+                raise
+            with self.lock:
+                self.metadata[tenant] = (metadata, time.time())
+                self.failures.pop(tenant, None)
+            return metadata
+        finally:
+            with self.lock:
+                self.pending.discard(tenant)
+
+    def discovery_url(self, tenant):
+        """Return the URL of a tenant's OpenID Connect metadata document."""
+        return (f'{self.authority_url(tenant)}/v2.0/'
+                '.well-known/openid-configuration')
+
+    def endpoints(self, tenant):
+        """Return a tenant's endpoints as a dictionary with
+        authorization_endpoint and token_endpoint keys.
+
+        Cached metadata is returned if available, including expired metadata
+        for up to grace seconds past ttl; missing, expired or soon-to-expire
+        metadata is (re)fetched in the background, for use by subsequent
+        calls.
+        """
+        with self.lock:
+            cached = self.metadata.get(tenant)
+        if cached:
+            metadata, fetched = cached
+            age = time.time() - fetched
+            if age >= self.ttl - self.refresh_ahead:
+                self.refresh(tenant)
+            if age < self.ttl + self.grace:
+                return metadata
+        else:
+            self.refresh(tenant)
+
+        authority = self.authority_url(tenant)
+        return {'authorization_endpoint': authority + config.AUTH_ENDPOINT,
+                'token_endpoint': authority + config.TOKEN_ENDPOINT}
+
+    def prefetch(self, *tenants):
+        """Start background discovery for tenants that aren't cached yet, so
+        that their first login uses discovered metadata."""
+        for tenant in tenants:
+            with self.lock:
+                cached = tenant in self.metadata
+            if not cached:
+                self.refresh(tenant)
+
+    def refresh(self, tenant):
+        """Schedule a background discovery request for a tenant, unless one is
+        already in flight or the last one failed too recently (see
+        retry_interval). Returns the Future, or None if not scheduled."""
+        with self.lock:
+            if tenant in self.pending:
+                return None
+            failed_at, failures = self.failures.get(tenant, (0, 0))
+            if failures:
+                backoff = min(self.retry_interval * 2 ** (failures - 1),
+                              self.ttl)
+                if time.time() < failed_at + backoff:
+                    return None
+            self.pending.add(tenant)
+        return self.executor.submit(self.discover, tenant)
+
+class Cassette(object):
+    """Recorder/player for HTTP request/response pairs.
+
+    In 'record' mode, requests are sent with Requests and each request and
+    its response are saved. In 'replay' mode, no network traffic occurs:
+    responses are returned from the saved interactions, matched in order by
+    HTTP method and URL (including query string). This allows deterministic
+    tests of code that uses GraphSession, with no need for live Azure AD and
+    Graph connections.
+
+    Cassettes are saved as gzip-compressed JSON. Response bodies are stored
+    as text where possible, base64-encoded otherwise. Tokens in JSON response
+    bodies (such as token endpoint responses) are replaced with placeholders,
+    and Set-Cookie headers are dropped, so that cassettes can be committed.
+    """
+    REDACTED_FIELDS = ('access_token', 'refresh_token', 'id_token')
+
+    def __init__(self, filename, *, mode='replay', latency=False):
+        """Initialize a cassette.
+
+        filename = cassette file; in 'replay' mode it must exist
+        mode = 'record' or 'replay'
+        latency = in 'replay' mode, whether to sleep for the recorded elapsed
+                  time of each response, to reproduce the original timings
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'unknown cassette mode: {mode}')
+        self.filename = filename
+        self.mode = mode
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0 # number of requests recorded or replayed
+        self.interactions = []
+        self.authstates = []
+        if mode == 'replay':
+            with gzip.open(filename, 'rt', encoding='utf-8') as fhandle:
+                saved = json.load(fhandle)
+            self.interactions = saved['interactions']
+            self.authstates = saved['authstates']
+            self.unplayed = collections.defaultdict(collections.deque)
+            for interaction in self.interactions:
+                self.unplayed[(interaction['method'],
+                               interaction['url'])].append(interaction)
+
+    def __repr__(self):
+        """Return string representation of class instance."""
+        return (f'<Cassette(filename={self.filename}, mode={self.mode}, '
+                f'calls={self.calls})>')
+
+    def authstate(self, state):
+        """Record the OAuth state sent by GraphSession.login(), or in 'replay'
+        mode return the next recorded state instead."""
+        with self.lock:
+            if self.mode == 'record':
+                self.authstates.append(state)
+                return state
+            if not self.authstates:
+                raise LookupError(f'no recorded login state in {self.filename}')
+            return self.authstates.pop(0)
+
+    def request(self, method, url, *, session=None, **kwargs):
+        """Send or replay an HTTP request. Arguments are the same as for
+        requests.request(); returns a Requests response object.
+
+        In 'record' mode, the request is sent (with session if specified) as
+        a streamed request, so that the caller can time the body download
+        separately. The caller must then pass the response to record(),
+        which saves the interaction.
+        """
+        method = method.upper()
+        if kwargs.get('params'):
+            # fold params into the URL so that replay matching doesn't
+            # depend on how the query string was passed
+            url = requests.Request(method, url,
+                                   params=kwargs.pop('params')).prepare().url
+        if self.mode == 'record':
+            kwargs['stream'] = True
+            response = (session or requests).request(method, url, **kwargs)
+            response.cassette_key = (method, url)
+            return response
+        return self.replay(method, url)
+
+    def record(self, response):
+        """Save the interaction for a response returned by request() in
+        'record' mode, reading its body if it hasn't been read yet."""
+        method, url = response.cassette_key
+        content = self.redact(response.content)
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() != 'set-cookie'}
+        interaction = {'method': method, 'url': url,
+                       'status': response.status_code,
+                       'reason': response.reason,
+                       'headers': headers,
+                       'elapsed': response.elapsed.total_seconds()}
+        try:
+            interaction['body'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body_b64'] = base64.b64encode(content).decode('ascii')
+        with self.lock:
+            self.calls += 1
+            self.interactions.append(interaction)
+
+    def redact(self, content):
+        """Return a response body with the values of REDACTED_FIELDS in a
+        JSON object replaced by placeholders."""
+        try:
+            body = json.loads(content)
+        except ValueError:
+            return content
+        if not isinstance(body, dict) or not any(field in body for field
+                                                 in self.REDACTED_FIELDS):
+            return content
+        for field in self.REDACTED_FIELDS:
+            if field in body:
+                body[field] = f'REDACTED_{field.upper()}'
+        return json.dumps(body).encode('utf-8')
+
+    def replay(self, method, url):
+        """Return a Requests response object for the next recorded interaction
+        that matches method and url."""
+        with self.lock:
+            queue = self.unplayed.get((method, url))
+            if not queue:
+                raise LookupError(f'no recorded response for {method} {url} '
+                                  f'in {self.filename}')
+            interaction = queue.popleft()
+            self.calls += 1
+        if self.latency:
+            time.sleep(interaction['elapsed'])
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            interaction['headers'])
+        response.url = url
+        response.encoding = 'utf-8'
+        response.elapsed = datetime.timedelta(seconds=interaction['elapsed'])
+        if 'body_b64' in interaction:
+            response._content = base64.b64decode(interaction['body_b64'])
+        else:
+            response._content = interaction['body'].encode('utf-8')
+        # the body is complete, so iter_content() and raw reads work for
+        # streamed requests too
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        return response
+
+    def save(self):
+        """Write recorded interactions to the cassette file ('record' mode)."""
+        if self.mode != 'record':
+            return
+        with self.lock:
+            saved = {'interactions': self.interactions,
+                     'authstates': self.authstates}
+        with gzip.open(self.filename, 'wt', encoding='utf-8') as fhandle:
+            json.dump(saved, fhandle, separators=(',', ':'))
+
+# Patterns for URL path segments that identify a resource rather than an
+# endpoint: GUIDs, numbers, user principal names and opaque Graph IDs (long
+# segments that contain a digit), plus non-empty key-as-parameter syntax such
+# as contacts('id'); function calls with no arguments, such as delta(), are
+# kept. See endpoint_template().
+ID_SEGMENT = re.compile(
+    r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+'
+    r'|[^/]*@[^/]*|(?=[^/]*\d)[^/]{16,})$', re.IGNORECASE)
+ID_PARAMETER = re.compile(r'\([^)]+\)')
+
+def endpoint_template(path):
+    """Return a URL path with resource IDs replaced by {id}, so that calls to
+    the same endpoint for different resources are aggregated together. For
+    example, /v1.0/me/contacts/AAMkAGI2TG93AAA= becomes
+    /v1.0/me/contacts/{id}."""
+    segments = []
+    for segment in path.split('/'):
+        segment = ID_PARAMETER.sub('({id})', segment)
+        segments.append('{id}' if ID_SEGMENT.match(segment) else segment)
+    return '/'.join(segments)
+
+class CallTimer(object):
+    """Per-call timing breakdown for a GraphSession request.
+
+    Phases, in seconds:
+    token -- access token validation (including any refresh)
+    serialize -- building the URL, headers and request body
+    connect -- DNS lookup, TCP connect and TLS handshake (0 if a pooled
+               connection was reused)
+    ttfb -- from sending the request to receiving the response headers
+    download -- reading the response body (0 for streamed responses)
+    decode -- JSON decoding, added when response.json() is called
+    total -- all phases except decode
+
+    The timings dictionary is attached to the response as response.timings.
+    """
+    PHASES = ('token', 'serialize', 'connect', 'ttfb', 'download', 'decode')
+
+    def __init__(self, method, url, profiler=None):
+        """Start timing a call. If a SamplingProfiler is specified, the call
+        is reported to it and may be selected for stack sampling."""
+        path = endpoint_template(urllib.parse.urlparse(url).path)
+        self.endpoint = f'{method.upper()} {path}'
+        self.profiler = profiler
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self.sampler = None
+        self.sampled = False # whether the profiler selected this call
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent in its block to a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def attach(self, response):
+        """Attach timings to a response, and wrap response.json() so that
+        JSON decoding time is recorded in the decode phase (and, for a
+        sampled call, stack-sampled too)."""
+        response.timings = self.timings
+        json_method = response.json
+
+        def timed_json(**kwargs):
+            sampler = None
+            if self.sampled:
+                sampler = self.profiler.start_sampler(self.endpoint,
+                                                      call=False)
+            start = time.perf_counter()
+            try:
+                return json_method(**kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if sampler:
+                    sampler.stop()
+                self.timings['decode'] += elapsed
+                if self.profiler:
+                    self.profiler.add_timings(self.endpoint,
+                                              {'decode': elapsed})
+
+        response.json = timed_json
+        return response
+
+    def start_sampling(self):
+        """Start stack sampling, if the profiler selects this call. Every call
+        must be matched by a stop_sampling() call in a finally clause, so that
+        the sampler thread is always stopped."""
+        if self.profiler:
+            self.sampler = self.profiler.sampler(self.endpoint)
+            self.sampled = self.sampler is not None
+
+    def stop_sampling(self):
+        """Stop stack sampling, if it was started, and report the samples."""
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler = None
+
+    def finish(self):
+        """Stop timing the call and report it to the profiler, if any."""
+        self.timings['total'] = time.perf_counter() - self.start
+        if self.profiler:
+            self.profiler.add_timings(self.endpoint, self.timings, call=True)
+
+class StackSampler(threading.Thread):
+    """Background thread that periodically samples the call stack of another
+    thread, for SamplingProfiler."""
+
+    def __init__(self, profiler, endpoint, thread_id, interval, call=True):
+        """Initialize a sampler for the thread identified by thread_id. call
+        is False if the samples continue an already-counted sampled call."""
+        super().__init__(daemon=True)
+        self.profiler = profiler
+        self.endpoint = endpoint
+        self.call = call
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.frames = collections.Counter() # frame -> samples it appeared in
+        self.leaves = collections.Counter() # frame -> samples it was running
+
+    def run(self):
+        """Sample the target thread's stack until stop() is called."""
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.leaves[self.frame_name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = self.frame_name(frame)
+                if name not in seen: # count recursive frames once
+                    seen.add(name)
+                    self.frames[name] += 1
+                frame = frame.f_back
+
+    def stop(self):
+        """Stop sampling and report the samples to the profiler."""
+        self.stopped.set()
+        self.join()
+        self.profiler.add_samples(self.endpoint, self.samples, self.frames,
+                                  self.leaves, call=self.call)
+
+    @staticmethod
+    def frame_name(frame):
+        """Return a 'function (file:line)' name for a stack frame."""
+        code = frame.f_code
+        return (f'{code.co_name} ({os.path.basename(code.co_filename)}:'
+                f'{frame.f_lineno})')
+
+class SamplingProfiler(object):
+    """Opt-in sampling profiler for GraphSession calls.
+
+    Timing breakdowns (see CallTimer) are aggregated for every call. A random
+    fraction of calls, determined by rate, are also profiled by sampling the
+    calling thread's stack every interval seconds, from the start of the
+    call (including token validation and serialization) to the end of the
+    response download, and again while response.json() decodes the body;
+    the hot frames are aggregated per endpoint (HTTP method and URL path).
+
+    To use it, pass an instance to GraphSession with the profiler argument
+    (a profiler can be shared by several sessions), and call save() to write
+    the aggregate to a JSON file that can be displayed with this command:
+    python graphprofile.py FILENAME
+    """
+
+    def __init__(self, rate=0.01, interval=0.001):
+        """Initialize a profiler.
+
+        rate = fraction of calls to stack-sample (0.0 to 1.0)
+        interval = seconds between stack samples of a sampled call
+        """
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def __repr__(self):
+        """Return string representation of class instance."""
+        return (f'<SamplingProfiler(rate={self.rate}, '
+                f'endpoints={len(self.endpoints)})>')
+
+    def add_samples(self, endpoint, samples, frames, leaves, call=True):
+        """Add stack samples to the aggregate. If call is True, the samples
+        are for a new sampled call and the sampled call count is
+        incremented."""
+        with self.lock:
+            stats = self.endpoint_stats(endpoint)
+            if call:
+                stats['sampled_calls'] += 1
+            stats['samples'] += samples
+            stats['frames'].update(frames)
+            stats['leaves'].update(leaves)
+
+    def add_timings(self, endpoint, timings, call=False):
+        """Add phase timings to the aggregate. If call is True, timings are
+        for a complete call and the endpoint's call count is incremented."""
+        with self.lock:
+            stats = self.endpoint_stats(endpoint)
+            if call:
+                stats['calls'] += 1
+            for phase, seconds in timings.items():
+                stats['timings'][phase] = (stats['timings'].get(phase, 0.0)
+                                           + seconds)
+
+    def endpoint_stats(self, endpoint):
+        """Return the aggregate dictionary for an endpoint (caller must hold
+        self.lock)."""
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'calls': 0, 'sampled_calls': 0, 'samples': 0, 'timings': {},
+                'frames': collections.Counter(),
+                'leaves': collections.Counter()}
+        return self.endpoints[endpoint]
+
+    def report(self):
+        """Return the aggregate as a JSON-serializable dictionary."""
+        with self.lock:
+            return {endpoint: {**stats, 'frames': dict(stats['frames']),
+                               'leaves': dict(stats['leaves'])}
+                    for endpoint, stats in self.endpoints.items()}
+
+    def sampler(self, endpoint):
+        """Decide whether to sample a call; if so, start and return a
+        StackSampler for the calling thread, otherwise return None."""
+        if random.random() >= self.rate:
+            return None
+        return self.start_sampler(endpoint)
+
+    def start_sampler(self, endpoint, call=True):
+        """Start and return a StackSampler for the calling thread."""
+        sampler = StackSampler(self, endpoint, threading.get_ident(),
+                               self.interval, call=call)
+        sampler.start()
+        return sampler
+
+    def save(self, filename):
+        """Write the aggregate to a JSON file."""
+        with open(filename, 'w') as fhandle:
+            fhandle.write(json.dumps(self.report(), indent=2))
+
 class GraphSession(object):
     """Microsoft Graph connection class.
 
@@ -46,6 +664,22 @@ class GraphSession(object):
                       cached, the token will be used without any user
                       authentication required ("silent SSO")
         refresh_enable = whether to auto-refresh expired tokens
+        authority_registry = optional AuthorityRegistry instance; if specified
+                             with tenant, auth_endpoint and token_endpoint are
+                             resolved via OpenID Connect discovery instead
+        tenant = tenant to authenticate against when authority_registry is
+                 specified (GUID, domain name, 'common', 'organizations' or
+                 'consumers')
+        cassette = optional filename of an HTTP cassette (see Cassette class);
+                   all HTTP traffic, including token endpoint calls, is
+                   recorded to or replayed from this file; after recording,
+                   call self.cassette.save() to write the file
+        cassette_mode = 'record' or 'replay' (default is 'replay')
+        cassette_latency = if True, replayed responses are delayed by the
+                           originally recorded response times; if False
+                           (the default), they are returned immediately
+        profiler = optional SamplingProfiler instance, which aggregates call
+                   timings and stack samples
         """
 
         self.config = {'client_id': config.CLIENT_ID,
@@ -58,7 +692,13 @@ class GraphSession(object):
                        'authority_url': config.AUTHORITY_URL,
                        'auth_endpoint': config.AUTHORITY_URL + config.AUTH_ENDPOINT,
                        'token_endpoint': config.AUTHORITY_URL + config.TOKEN_ENDPOINT,
-                       'refresh_enable': True}
+                       'refresh_enable': True,
+                       'authority_registry': None,
+                       'tenant': None,
+                       'cassette': None,
+                       'cassette_mode': 'replay',
+                       'cassette_latency': False,
+                       'profiler': None}
 
         # Print warning if any unknown arguments were passed, since those may be
         # errors/typos.
@@ -68,11 +708,36 @@ class GraphSession(object):
 
         self.config.update(kwargs.items()) # add passed arguments to config
 
+        # pooled connections for Graph calls, with connect timing
+        self.http_session = timing_session()
+
+        # Set up the HTTP cassette, if any, before state_manager() because a
+        # cached token may be refreshed during initialization.
+        self.cassette = None
+        if self.config['cassette']:
+            self.cassette = Cassette(self.config['cassette'],
+                                     mode=self.config['cassette_mode'],
+                                     latency=self.config['cassette_latency'])
+
+        # OpenID metadata discovered through the cassette (see
+        # authority_endpoints())
+        self.cassette_metadata = None
+
+        # Start discovery for this tenant now, so that it's usually complete
+        # before the first login. Not done with a cassette, because that
+        # discovery must be recorded/replayed in this session's call order.
+        if (self.config['authority_registry'] and self.config['tenant']
+                and not self.cassette):
+            self.config['authority_registry'].prefetch(self.config['tenant'])
+
         self.state_manager('init')
 
         # used by login() and redirect_uri_handler() to identify current session
         self.authstate = ''
 
+        # serializes token validation/refresh across bulk_write() worker threads
+        self.token_lock = threading.Lock()
+
         # route to redirect to after authentication; can be overridden in login()
         self.login_redirect = '/'
 
@@ -100,6 +765,215 @@ class GraphSession(object):
             f"{self.config['resource']}{self.config['api_version']}/",
             url.lstrip('/'))
 
+    def authority_endpoints(self):
+        """Return a dictionary with the authorization_endpoint and
+        token_endpoint for this session, from the authority registry if one
+        is configured or from config settings if not.
+
+        If a cassette is active, the registry's background discovery isn't
+        used. Instead, the metadata is retrieved once, synchronously, through
+        the cassette, so that recorded and replayed sessions always use the
+        same endpoints and a replay never contacts the login host.
+        """
+        registry = self.config['authority_registry']
+        if registry and self.config['tenant'] and self.cassette:
+            if self.cassette_metadata is None:
+                response = self.http_request(
+                    'GET', registry.discovery_url(self.config['tenant']),
+                    session=registry.session)
+                response.raise_for_status()
+                self.cassette_metadata = response.json()
+            return self.cassette_metadata
+        if registry and self.config['tenant']:
+            return registry.endpoints(self.config['tenant'])
+        return {'authorization_endpoint': self.config['auth_endpoint'],
+                'token_endpoint': self.config['token_endpoint']}
+
+    def bulk_write(self, operations, *, max_workers=4, max_retries=3,
+                   report=None):
+        """Dispatch a stream of POST/PATCH/PUT/DELETE operations to Graph.
+
+        operations = iterable of dictionaries, each with these keys:
+                     method -- 'POST', 'PATCH', 'PUT' or 'DELETE'
+                     endpoint -- URL (can be partial; e.g., 'me/contacts')
+                     data -- optional request body (dicts are JSON-encoded)
+                     headers -- optional HTTP headers
+                     params -- optional query string parameters
+                     key -- optional ordering key; operations that share a key
+                            are sent one at a time, in the order received.
+                            Defaults to the endpoint for PATCH/PUT/DELETE, so
+                            all writes to one resource stay in order. POSTs
+                            with no key are unordered.
+        max_workers = maximum number of concurrent requests
+        max_retries = number of retries for throttled (429) or unavailable
+                      (503/504) responses and connection errors. A POST is
+                      not idempotent, so after other errors (such as the
+                      connection dropping while awaiting the response) it
+                      fails without being retried, and can be re-submitted
+                      deliberately via the report and bulk_failures()
+        report = optional filename; one JSON line per operation is written to
+                 it, with the outcome and the original operation (bytes
+                 bodies are saved base64-encoded). Failed operations can be
+                 re-submitted with bulk_failures().
+
+        The operations iterable is consumed lazily; at most 2 * max_workers
+        operations are held in memory at any time. An invalid operation (not
+        a dict, or with a missing or unsupported method or endpoint) gets a
+        failed report entry and doesn't stop the other operations.
+
+        Returns a summary dictionary: succeeded, retried and failed counts,
+        plus a list of the report entries for the failed operations.
+        """
+        summary = {'succeeded': 0, 'retried': 0, 'failed': 0, 'failures': []}
+        lock = threading.Lock()
+        waiting = {} # key -> deque of (index, operation) behind in-flight op
+        slots = threading.BoundedSemaphore(2 * max_workers)
+        fhandle = open(report, 'w') if report else None
+        report_errors = [] # exceptions raised while writing the report
+
+        def record(entry):
+            with lock:
+                if entry['attempts'] > 1:
+                    summary['retried'] += 1
+                if entry['outcome'] == 'succeeded':
+                    summary['succeeded'] += 1
+                else:
+                    summary['failed'] += 1
+                    summary['failures'].append(entry)
+                if fhandle:
+                    fhandle.write(bulk_report_line(entry) + '\n')
+
+        def run_chain(key, index, operation):
+            # Send this operation, then any that queued up behind it on the
+            # same key, so per-key order is preserved without holding a
+            # worker thread idle while other keys have work.
+            while True:
+                try:
+                    entry = self.bulk_send(index, operation, max_retries)
+                except Exception as err: # keep the chain moving
+                    entry = {'index': index, 'method': operation['method'],
+                             'endpoint': operation['endpoint'], 'status': None,
+                             'attempts': 1, 'outcome': 'failed',
+                             'error': repr(err), 'operation': operation}
+                # The slot must be released and the next operation dequeued
+                # even if the report can't be written, or bulk_write() would
+                # block forever waiting for a free slot.
+                try:
+                    record(entry)
+                except Exception as err:
+                    report_errors.append(err)
+                finally:
+                    slots.release()
+                    with lock:
+                        queue = waiting.get(key)
+                        following = queue.popleft() if queue else None
+                        if not following:
+                            waiting.pop(key, None)
+                if not following:
+                    return
+                index, operation = following
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                operations = iter(operations)
+                end = object() # marks the end of operations
+                for index in itertools.count():
+                    # take a slot before reading the next operation, so that
+                    # no more than 2 * max_workers are held at once
+                    slots.acquire()
+                    operation = next(operations, end)
+                    if operation is end:
+                        slots.release()
+                        break
+                    try:
+                        key = bulk_key(index, operation, self.api_endpoint)
+                    except Exception as err:
+                        # a malformed operation fails on its own, without
+                        # stopping the rest of the stream
+                        try:
+                            record({'index': index, 'method': None,
+                                    'endpoint': None, 'status': None,
+                                    'attempts': 0, 'outcome': 'failed',
+                                    'error': f'invalid operation: {err!r}',
+                                    'operation': operation})
+                        except Exception as report_err:
+                            report_errors.append(report_err)
+                        finally:
+                            slots.release()
+                        continue
+                    with lock:
+                        if key in waiting:
+                            waiting[key].append((index, operation))
+                            continue
+                        waiting[key] = collections.deque()
+                    executor.submit(run_chain, key, index, operation)
+        finally:
+            if fhandle:
+                fhandle.close()
+        if report_errors:
+            raise report_errors[0]
+        return summary
+
+    def bulk_send(self, index, operation, max_retries=3):
+        """Send a single bulk_write() operation, retrying if throttled.
+
+        Returns a JSON-serializable report entry for the operation.
+        """
+        method = operation['method'].upper()
+        entry = {'index': index, 'method': method,
+                 'endpoint': operation['endpoint'], 'status': None,
+                 'attempts': 0, 'outcome': 'failed', 'error': None,
+                 'operation': operation}
+
+        for attempt in range(max_retries + 1):
+            entry['attempts'] = attempt + 1
+            timer = self.call_timer(method, operation['endpoint'])
+            try:
+                with timer.phase('token'), self.token_lock:
+                    self.token_validation()
+                with timer.phase('serialize'):
+                    url = self.api_endpoint(operation['endpoint'])
+                    headers = self.headers(operation.get('headers'))
+                    data = operation.get('data')
+                    if isinstance(data, (dict, list)):
+                        data = json.dumps(data)
+                response = self.http_request(
+                    method, url, headers=headers, data=data, verify=False,
+                    params=operation.get('params'), timer=timer)
+                entry['status'] = response.status_code
+                if response.ok:
+                    entry['outcome'] = 'succeeded'
+                    entry['error'] = None
+                    break
+                entry['error'] = response.text[:500]
+                if response.status_code not in (429, 503, 504):
+                    break
+                retry_after = retry_after_seconds(
+                    response.headers.get('Retry-After'), 2 ** attempt)
+            except requests.exceptions.RequestException as err:
+                entry['status'] = None
+                entry['error'] = str(err)
+                if method == 'POST' and not connection_failed(err):
+                    # The request may have been processed (for example,
+                    # the connection dropped after Graph created the
+                    # resource), so retrying could create a duplicate.
+                    break
+                retry_after = 2 ** attempt
+            finally:
+                timer.stop_sampling()
+            if attempt < max_retries:
+                time.sleep(retry_after)
+        return entry
+
+    def call_timer(self, method, endpoint):
+        """Return a CallTimer for a call to an API endpoint, with stack
+        sampling started if the profiler selects the call. The caller must
+        call stop_sampling() on it, in a finally clause."""
+        timer = CallTimer(method, self.api_endpoint(endpoint),
+                          self.config['profiler'])
+        timer.start_sampling()
+        return timer
+
     def delete(self, endpoint, *, headers=None, data=None, verify=False,
                params=None):
         """Wrapper for authenticated HTTP DELETE to API endpoint.
@@ -115,10 +989,17 @@ class GraphSession(object):
 
         Returns Requests response object.
         """
-        self.token_validation()
-        return requests.delete(self.api_endpoint(endpoint),
-                               headers=self.headers(headers),
-                               data=data, verify=verify, params=params)
+        timer = self.call_timer('DELETE', endpoint)
+        try:
+            with timer.phase('token'):
+                self.token_validation()
+            with timer.phase('serialize'):
+                url = self.api_endpoint(endpoint)
+                headers = self.headers(headers)
+            return self.http_request('DELETE', url, headers=headers, data=data,
+                                     verify=verify, params=params, timer=timer)
+        finally:
+            timer.stop_sampling()
 
     def get(self, endpoint='me', *, headers=None, stream=False, verify=False, params=None):
         """Wrapper for authenticated HTTP GET to API endpoint.
@@ -134,15 +1015,22 @@ class GraphSession(object):
 
         Returns Requests response object.
         """
-        self.token_validation()
-        # Merge passed headers with default headers.
-        merged_headers = self.headers()
-        if headers:
-            merged_headers.update(headers)
+        timer = self.call_timer('GET', endpoint)
+        try:
+            with timer.phase('token'):
+                self.token_validation()
+            with timer.phase('serialize'):
+                url = self.api_endpoint(endpoint)
+                # Merge passed headers with default headers.
+                merged_headers = self.headers()
+                if headers:
+                    merged_headers.update(headers)
 
-        return requests.get(self.api_endpoint(endpoint),
-                            headers=merged_headers,
-                            stream=stream, verify=verify, params=params)
+            return self.http_request('GET', url, headers=merged_headers,
+                                     stream=stream, verify=verify,
+                                     params=params, timer=timer)
+        finally:
+            timer.stop_sampling()
 
     def headers(self, headers=None):
         """Return a dict of default HTTP headers for calls to Microsoft Graph API,
@@ -165,6 +1053,54 @@ class GraphSession(object):
             merged_headers.update(headers)
         return merged_headers
 
+    def http_request(self, method, url, *, session=None, timer=None,
+                     stream=False, **kwargs):
+        """Send an HTTP request, through the cassette if one is configured.
+
+        All HTTP traffic from GraphSession (Graph API calls and token endpoint
+        calls) goes through this method. Optional arguments:
+        session = Requests session to send the request with; defaults to
+                  self.http_session
+        timer = CallTimer for this call, which the caller is responsible for
+                stopping; if not provided, one is created and stopped here
+        stream = Requests streaming option
+        Other arguments are the same as for requests.request().
+
+        Returns a Requests response object, with the call's timing breakdown
+        attached as response.timings (see CallTimer).
+        """
+        own_timer = timer is None
+        if own_timer:
+            timer = self.call_timer(method, url)
+        session = session or self.http_session
+        CONNECT_TIMING.seconds = 0.0
+        try:
+            # Always stream (a recording cassette does too), so that the
+            # response body is read separately and the download phase can be
+            # measured.
+            with timer.phase('ttfb'):
+                if self.cassette:
+                    response = self.cassette.request(method, url,
+                                                     session=session, **kwargs)
+                else:
+                    response = session.request(method, url, stream=True,
+                                               **kwargs)
+            if not stream:
+                with timer.phase('download'):
+                    response.content # pylint: disable=pointless-statement
+            if self.cassette and self.cassette.mode == 'record':
+                self.cassette.record(response)
+        finally:
+            # connect() is called within the request, so move its time from
+            # the ttfb phase to the connect phase
+            connect = getattr(CONNECT_TIMING, 'seconds', 0.0)
+            timer.timings['connect'] += connect
+            timer.timings['ttfb'] -= connect
+            timer.finish()
+            if own_timer:
+                timer.stop_sampling()
+        return timer.attach(response)
+
     def login(self, login_redirect=None):
         """Ask user to authenticate via Azure Active Directory.
         Optional login_redirect argument is route to redirect to after user
@@ -178,6 +1114,10 @@ class GraphSession(object):
                 return bottle.redirect(self.login_redirect)
 
         self.authstate = str(uuid.uuid4())
+        if self.cassette:
+            # the redirect received by redirect_uri_handler() must carry the
+            # same state that was sent when the cassette was recorded
+            self.authstate = self.cassette.authstate(self.authstate)
         data = {
             'response_type': 'code',
             'client_id': self.config['client_id'],
@@ -187,10 +1127,16 @@ class GraphSession(object):
             'prompt': 'select_account',
         }
         params = urllib.parse.urlencode(data)
-        url = f"{self.config['auth_endpoint']}?{params}"
+        url = f"{self.authority_endpoints()['authorization_endpoint']}?{params}"
         self.state['authorization_url'] = url
         bottle.redirect(self.state['authorization_url'], 302)
 
+    def login_session(self):
+        """Return the pooled Requests session shared by all tenants for calls
+        to the login host, or None if there is no authority registry."""
+        registry = self.config['authority_registry']
+        return registry.session if registry else None
+
     def logout(self, redirect_to=None):
         """Clear current Graph connection state and redirect to specified route.
 
@@ -216,10 +1162,17 @@ class GraphSession(object):
 
         Returns Requests response object.
         """
-        self.token_validation()
-        return requests.patch(self.api_endpoint(endpoint),
-                              headers=self.headers(headers),
-                              data=data, verify=verify, params=params)
+        timer = self.call_timer('PATCH', endpoint)
+        try:
+            with timer.phase('token'):
+                self.token_validation()
+            with timer.phase('serialize'):
+                url = self.api_endpoint(endpoint)
+                headers = self.headers(headers)
+            return self.http_request('PATCH', url, headers=headers, data=data,
+                                     verify=verify, params=params, timer=timer)
+        finally:
+            timer.stop_sampling()
 
     def post(self, endpoint, headers=None, data=None, verify=False, params=None):
         """POST to API (authenticated with access token).
@@ -230,14 +1183,21 @@ class GraphSession(object):
                  to False for demo purposes. For more information see:
         http://docs.python-requests.org/en/master/user/advanced/#ssl-cert-verification
         """
-        self.token_validation()
-        merged_headers = self.headers()
-        if headers:
-            merged_headers.update(headers)
+        timer = self.call_timer('POST', endpoint)
+        try:
+            with timer.phase('token'):
+                self.token_validation()
+            with timer.phase('serialize'):
+                url = self.api_endpoint(endpoint)
+                merged_headers = self.headers()
+                if headers:
+                    merged_headers.update(headers)
 
-        return requests.post(self.api_endpoint(endpoint),
-                             headers=merged_headers, data=data,
-                             verify=verify, params=params)
+            return self.http_request('POST', url, headers=merged_headers,
+                                     data=data, verify=verify, params=params,
+                                     timer=timer)
+        finally:
+            timer.stop_sampling()
 
     def put(self, endpoint, *, headers=None, data=None, verify=False, params=None):
         """Wrapper for authenticated HTTP PUT to API endpoint.
@@ -253,10 +1213,17 @@ class GraphSession(object):
 
         Returns Requests response object.
         """
-        self.token_validation()
-        return requests.put(self.api_endpoint(endpoint),
-                            headers=self.headers(headers),
-                            data=data, verify=verify, params=params)
+        timer = self.call_timer('PUT', endpoint)
+        try:
+            with timer.phase('token'):
+                self.token_validation()
+            with timer.phase('serialize'):
+                url = self.api_endpoint(endpoint)
+                headers = self.headers(headers)
+            return self.http_request('PUT', url, headers=headers, data=data,
+                                     verify=verify, params=params, timer=timer)
+        finally:
+            timer.stop_sampling()
 
     def redirect_uri_handler(self):
         """Redirect URL handler for AuthCode workflow. Uses the authorization
@@ -276,8 +1243,9 @@ class GraphSession(object):
             'code': bottle.request.query.code,
             'redirect_uri': self.config['redirect_uri']
         }
-        token_response = requests.post(self.config['token_endpoint'],
-                                       data=data)
+        token_response = self.http_request(
+            'POST', self.authority_endpoints()['token_endpoint'],
+            data=data, session=self.login_session())
         self.token_save(token_response)
 
         if token_response and token_response.ok:
@@ -331,15 +1299,16 @@ class GraphSession(object):
             'grant_type': 'refresh_token',
             'refresh_token': self.state['refresh_token'],
         }
-        response = requests.post(self.config['token_endpoint'],
-                                 data=data, verify=False)
+        response = self.http_request(
+            'POST', self.authority_endpoints()['token_endpoint'],
+            data=data, verify=False, session=self.login_session())
         self.token_save(response)
 
     def token_save(self, response):
         """Parse an access token out of the JWT response from token endpoint and save it.
 
         Arguments:
-        response -- response object returned by self.config['token_endpoint'], which
+        response -- response object returned by the token endpoint, which
                     contains a JSON web token
 
         Returns True if the token was successfully saved, False if not.
@@ -385,3 +1354,89 @@ class GraphSession(object):
         if scopes_expected != scopes_returned:
             print(f'scopes {list(scopes_expected)} requested, but scopes '
                   f'{list(scopes_returned)} returned with token')
+
+
+def bulk_key(index, operation, api_endpoint):
+    """Validate a bulk_write() operation and return its ordering key.
+
+    api_endpoint is the GraphSession.api_endpoint method, used to derive the
+    default key. Raises TypeError or ValueError if the operation is invalid.
+    """
+    if not isinstance(operation, dict):
+        raise TypeError(f'operation must be a dict, not '
+                        f'{type(operation).__name__}')
+    method = operation.get('method')
+    if not isinstance(method, str) or method.upper() not in (
+            'POST', 'PATCH', 'PUT', 'DELETE'):
+        raise ValueError(f'unsupported method: {method!r}')
+    if not isinstance(operation.get('endpoint'), str):
+        raise ValueError('endpoint must be a string')
+    key = operation.get('key')
+    if key is None and method.upper() != 'POST':
+        key = api_endpoint(operation['endpoint'])
+    if key is None:
+        key = ('unordered', index)
+    hash(key) # raises TypeError for an unusable key, such as a list
+    return key
+
+def bulk_report_line(entry):
+    """Return a bulk_write() report entry as a line of JSON. A bytes request
+    body is saved as a base64 string, under a data_b64 key."""
+    operation = entry['operation']
+    if isinstance(operation, dict) and isinstance(operation.get('data'),
+                                                  bytes):
+        operation = {key: value for key, value in operation.items()
+                     if key != 'data'}
+        operation['data_b64'] = base64.b64encode(
+            entry['operation']['data']).decode('ascii')
+        entry = {**entry, 'operation': operation}
+    # repr() any other non-JSON values (such as a malformed operation), so
+    # that a report line can always be written
+    return json.dumps(entry, default=repr)
+
+def bulk_failures(report):
+    """Generator that yields the failed operations from a bulk_write() report
+    file, in their original order, so that they can be passed back to
+    bulk_write() to be replayed.
+    """
+    entries = []
+    with open(report) as fhandle:
+        for line in fhandle:
+            entry = json.loads(line)
+            if entry['outcome'] != 'succeeded':
+                entries.append(entry)
+    for entry in sorted(entries, key=lambda entry: entry['index']):
+        operation = entry['operation']
+        if 'data_b64' in operation:
+            operation['data'] = base64.b64decode(operation.pop('data_b64'))
+        yield operation
+
+
+def connection_failed(err):
+    """Return True if a Requests exception means that no connection to the
+    server was established, so the request can't have been received."""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = err.args[0] if err.args else None
+    reason = getattr(reason, 'reason', reason) # unwrap MaxRetryError
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError,
+                               urllib3.exceptions.ConnectTimeoutError))
+
+def retry_after_seconds(value, default):
+    """Return the number of seconds to wait for a Retry-After header value,
+    which can be a number of seconds or an HTTP-date. Returns default if the
+    value is missing or can't be parsed."""
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0, (retry_at - now).total_seconds())
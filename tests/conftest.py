@@ -0,0 +1,88 @@
+"""Shared fixtures for graphrest tests."""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import http.server
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+# config.py exits if it hasn't been edited to contain app credentials, so
+# tests use these settings instead. Endpoints are overridden per test.
+sys.modules['config'] = types.SimpleNamespace(
+    CLIENT_ID='test-client-id', CLIENT_SECRET='test-client-secret',
+    REDIRECT_URI='http://localhost:5000/login/authorized',
+    AUTHORITY_URL='http://127.0.0.1:9/common',
+    AUTH_ENDPOINT='/oauth2/v2.0/authorize',
+    TOKEN_ENDPOINT='/oauth2/v2.0/token',
+    RESOURCE='http://127.0.0.1:9/', API_VERSION='v1.0',
+    SCOPES=['User.Read'])
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class GraphServer(object):
+    """Local HTTP server that records requests and answers them with a
+    test-provided handler function.
+
+    handler(method, path, body) must return (status, headers, body bytes).
+    """
+
+    def __init__(self):
+        self.handler = lambda method, path, body: (200, {}, b'{}')
+        self.requests = [] # (method, path, body) in order received
+        self.lock = threading.Lock()
+        server = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                with server.lock:
+                    server.requests.append((self.command, self.path, body))
+                status, headers, content = server.handler(self.command,
+                                                          self.path, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = respond
+
+            def log_message(self, *args): # keep test output quiet
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     RequestHandler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/'
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Shut down the server."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    """A running GraphServer."""
+    graph_server = GraphServer()
+    yield graph_server
+    graph_server.stop()
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run each test in a temporary directory, because GraphSession reads and
+    removes state.json in the current directory."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
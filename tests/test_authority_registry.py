@@ -0,0 +1,182 @@
+"""Tests for AuthorityRegistry."""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import concurrent.futures
+import json
+import threading
+import time
+
+import graphrest
+
+
+def discovery_server(server):
+    """Configure the test server as a login host for tenant 'contoso'."""
+    def handler(method, path, body):
+        if path == '/contoso/v2.0/.well-known/openid-configuration':
+            return 200, {}, json.dumps(
+                {'authorization_endpoint': server.url + 'tenant-id/authorize',
+                 'token_endpoint': server.url + 'tenant-id/token'}
+            ).encode('utf-8')
+        if path == '/tenant-id/token':
+            return 200, {}, json.dumps(
+                {'access_token': 'token', 'scope': 'User.Read',
+                 'expires_in': 3600}).encode('utf-8')
+        return 404, {}, b'{}'
+    server.handler = handler
+
+
+def test_fallback_then_discovered(server):
+    """Endpoints fall back to config paths until discovery completes."""
+    discovery_server(server)
+    registry = graphrest.AuthorityRegistry(login_host=server.url)
+
+    fallback = registry.endpoints('contoso')
+    assert fallback['token_endpoint'] == (server.url +
+                                          'contoso/oauth2/v2.0/token')
+    registry.refresh('contoso') # may be None if still pending
+    registry.executor.shutdown(wait=True)
+    assert registry.endpoints('contoso')['token_endpoint'] == (
+        server.url + 'tenant-id/token')
+
+
+def test_cassette_discovery(server, workdir):
+    """With a cassette, discovery is recorded and replayed, so a replayed
+    session never contacts the login host."""
+    discovery_server(server)
+    cassette = str(workdir / 'session.cassette')
+
+    recorder = graphrest.GraphSession(
+        authority_registry=graphrest.AuthorityRegistry(login_host=server.url),
+        tenant='contoso', cassette=cassette, cassette_mode='record')
+    recorder.state['refresh_token'] = 'refresh'
+    recorder.token_refresh()
+    recorder.cassette.save()
+    server.stop()
+
+    player = graphrest.GraphSession(
+        authority_registry=graphrest.AuthorityRegistry(login_host=server.url),
+        tenant='contoso', cassette=cassette, cassette_mode='replay')
+    player.state['refresh_token'] = 'refresh'
+    player.token_refresh()
+    assert player.state['loggedin']
+    assert player.cassette.calls == recorder.cassette.calls == 2
+
+
+def test_no_shared_cookies(server):
+    """Cookies set by the login host aren't kept by the shared session."""
+    discovery_server(server)
+    discovery_handler = server.handler
+
+    def handler(method, path, body):
+        status, headers, content = discovery_handler(method, path, body)
+        return status, {**headers, 'Set-Cookie': 'fpc=secret; Path=/'}, content
+    server.handler = handler
+    registry = graphrest.AuthorityRegistry(login_host=server.url)
+    session = graphrest.GraphSession(authority_registry=registry,
+                                     tenant='contoso')
+    registry.executor.shutdown(wait=True) # wait for prefetch()
+    session.state['refresh_token'] = 'refresh'
+    session.token_refresh()
+
+    assert session.state['loggedin']
+    assert not registry.session.cookies
+    assert not session.http_session.cookies
+
+
+def test_failed_discovery_backoff(server, capsys):
+    """A failed discovery is reported and not retried until the backoff
+    interval has passed."""
+    server.handler = lambda method, path, body: (500, {}, b'{}')
+    registry = graphrest.AuthorityRegistry(login_host=server.url,
+                                           retry_interval=60)
+
+    concurrent.futures.wait([registry.refresh('contoso')])
+    for _ in range(5):
+        registry.endpoints('contoso')
+
+    assert len(server.requests) == 1
+    assert 'discovery for tenant "contoso" failed' in capsys.readouterr().out
+    failed_at, failures = registry.failures['contoso']
+    registry.failures['contoso'] = (failed_at - 61, failures)
+    assert registry.refresh('contoso') is not None
+
+
+def test_expired_metadata_grace(server):
+    """Metadata past ttl + grace is no longer used."""
+    discovery_server(server)
+    registry = graphrest.AuthorityRegistry(login_host=server.url, ttl=100,
+                                           grace=50)
+    registry.discover('contoso')
+    metadata, fetched = registry.metadata['contoso']
+    server.handler = lambda method, path, body: (500, {}, b'{}')
+
+    registry.metadata['contoso'] = (metadata, fetched - 120)
+    assert registry.endpoints('contoso') == metadata
+    registry.metadata['contoso'] = (metadata, fetched - 160)
+    assert registry.endpoints('contoso')['token_endpoint'] == (
+        server.url + 'contoso/oauth2/v2.0/token')
+
+
+def discovery_requests(server):
+    """Return the number of discovery requests the server has received."""
+    return sum(1 for method, path, body in server.requests
+               if path.endswith('openid-configuration'))
+
+
+def test_refresh_ahead(server):
+    """Metadata close to expiry is served while being re-discovered once."""
+    discovery_server(server)
+    registry = graphrest.AuthorityRegistry(login_host=server.url, ttl=100,
+                                           refresh_ahead=10)
+    metadata = registry.discover('contoso')
+
+    registry.endpoints('contoso') # fresh: no refresh
+    assert discovery_requests(server) == 1
+
+    registry.metadata['contoso'] = (metadata, time.time() - 95)
+    for _ in range(5):
+        assert registry.endpoints('contoso') == metadata
+    registry.executor.shutdown(wait=True)
+
+    assert discovery_requests(server) == 2
+    assert time.time() - registry.metadata['contoso'][1] < 5
+
+
+def test_pending_deduplicated(server):
+    """Only one discovery request per tenant is in flight at a time."""
+    discovery_server(server)
+    discovery_handler = server.handler
+    release = threading.Event()
+
+    def handler(method, path, body):
+        release.wait(5)
+        return discovery_handler(method, path, body)
+    server.handler = handler
+    registry = graphrest.AuthorityRegistry(login_host=server.url)
+
+    future = registry.refresh('contoso')
+    assert future is not None
+    for _ in range(5):
+        assert registry.refresh('contoso') is None
+        registry.endpoints('contoso')
+        registry.prefetch('contoso')
+    release.set()
+    future.result()
+
+    assert discovery_requests(server) == 1
+    assert not registry.pending
+
+
+def test_session_prefetch(server):
+    """Creating a GraphSession starts discovery for its tenant, so the first
+    login uses discovered endpoints."""
+    discovery_server(server)
+    registry = graphrest.AuthorityRegistry(login_host=server.url)
+
+    session = graphrest.GraphSession(authority_registry=registry,
+                                     tenant='contoso')
+    registry.executor.shutdown(wait=True)
+
+    assert discovery_requests(server) == 1
+    assert session.authority_endpoints()['token_endpoint'] == (
+        server.url + 'tenant-id/token')
@@ -0,0 +1,168 @@
+"""Tests for GraphSession.bulk_write() and bulk_failures()."""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import email.utils
+import json
+import random
+import threading
+import time
+
+import graphrest
+
+
+def graph_session(server):
+    """Return a GraphSession that sends Graph calls to the test server."""
+    return graphrest.GraphSession(resource=server.url, refresh_enable=False)
+
+
+def test_per_key_order(server):
+    """Operations on the same resource are sent in order."""
+    def handler(method, path, body):
+        time.sleep(random.uniform(0, 0.005))
+        return 200, {}, b'{}'
+    server.handler = handler
+
+    operations = [{'method': 'PATCH', 'endpoint': f'me/contacts/{n % 3}',
+                   'data': {'sequence': n}} for n in range(30)]
+    summary = graph_session(server).bulk_write(iter(operations), max_workers=4)
+
+    assert summary['succeeded'] == 30
+    for contact in range(3):
+        received = [json.loads(body)['sequence']
+                    for method, path, body in server.requests
+                    if path == f'/v1.0/me/contacts/{contact}']
+        assert received == list(range(contact, 30, 3))
+
+
+def test_bounded_window(server):
+    """At most max_workers requests are in flight and at most 2 * max_workers
+    operations have been read from the iterable but not completed."""
+    lock = threading.Lock()
+    state = {'active': 0, 'max_active': 0, 'yielded': 0, 'handled': 0,
+             'max_pending': 0}
+
+    def handler(method, path, body):
+        with lock:
+            state['active'] += 1
+            state['max_active'] = max(state['max_active'], state['active'])
+        time.sleep(0.002)
+        with lock:
+            state['active'] -= 1
+            state['handled'] += 1
+        return 201, {}, b'{}'
+    server.handler = handler
+
+    def operations():
+        for n in range(40):
+            with lock:
+                state['yielded'] += 1
+                state['max_pending'] = max(state['max_pending'],
+                                           state['yielded'] - state['handled'])
+            yield {'method': 'POST', 'endpoint': 'me/contacts',
+                   'data': {'n': n}}
+
+    summary = graph_session(server).bulk_write(operations(), max_workers=3)
+
+    assert summary['succeeded'] == 40
+    assert state['max_active'] <= 3
+    assert state['max_pending'] <= 6
+
+
+def test_retry_throttled(server):
+    """Throttled requests are retried, including with an HTTP-date
+    Retry-After header."""
+    retry_at = email.utils.formatdate(time.time() - 1, usegmt=True)
+    responses = iter([(429, {'Retry-After': retry_at}, b'{}'),
+                      (429, {'Retry-After': '0'}, b'{}'),
+                      (204, {}, b'')])
+    server.handler = lambda method, path, body: next(responses)
+
+    summary = graph_session(server).bulk_write(
+        [{'method': 'DELETE', 'endpoint': 'me/contacts/1'}])
+
+    assert summary['succeeded'] == 1
+    assert summary['retried'] == 1
+    assert len(server.requests) == 3
+
+
+def test_report_replay(server, workdir):
+    """Failed operations in a report, including bytes bodies, are replayed by
+    bulk_failures() in their original order."""
+    server.handler = lambda method, path, body: (
+        (400, {}, b'{"error": "bad"}') if b'fail' in body else (200, {}, b'{}'))
+    operations = [{'method': 'PATCH', 'endpoint': f'me/contacts/{n}',
+                   'data': b'fail' if n % 2 else b'ok'} for n in range(6)]
+    report = str(workdir / 'report.jsonl')
+
+    summary = graph_session(server).bulk_write(operations, max_workers=1,
+                                               report=report)
+
+    assert summary['succeeded'] == 3
+    assert summary['failed'] == 3
+    assert list(graphrest.bulk_failures(report)) == operations[1::2]
+
+
+def test_retry_after_seconds():
+    """Both Retry-After forms are parsed; invalid values use the default."""
+    retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert graphrest.retry_after_seconds('7', 1) == 7
+    assert 25 < graphrest.retry_after_seconds(retry_at, 1) <= 30
+    assert graphrest.retry_after_seconds('soon', 4) == 4
+    assert graphrest.retry_after_seconds(None, 2) == 2
+
+
+def test_post_not_retried_after_send(server):
+    """A POST whose connection drops after sending isn't retried, but a
+    PATCH is."""
+    dropped = set()
+
+    def handler(method, path, body):
+        if path not in dropped: # drop the first request to each path
+            dropped.add(path)
+            raise ConnectionResetError
+        return 200, {}, b'{}'
+    server.handler = handler
+    session = graph_session(server)
+
+    posted = session.bulk_write([{'method': 'POST', 'endpoint': 'me/contacts'}])
+    assert posted['failed'] == 1
+    assert posted['failures'][0]['attempts'] == 1
+    assert len(server.requests) == 1
+
+    patched = session.bulk_write([{'method': 'PATCH',
+                                   'endpoint': 'me/contacts/1'}])
+    assert patched['succeeded'] == 1
+    assert patched['retried'] == 1
+
+
+def test_post_retried_if_not_connected():
+    """A POST that couldn't connect is retried."""
+    session = graphrest.GraphSession(resource='http://127.0.0.1:9/',
+                                     refresh_enable=False)
+    summary = session.bulk_write([{'method': 'POST', 'endpoint': 'me/contacts'}],
+                                 max_retries=1)
+    assert summary['failures'][0]['attempts'] == 2
+
+
+def test_invalid_operations(server, workdir):
+    """Malformed operations and None items fail individually; the rest of
+    the stream is still sent."""
+    report = str(workdir / 'report.jsonl')
+    operations = [{'method': 'PATCH', 'endpoint': 'me/contacts/1'},
+                  None,
+                  {'endpoint': 'me/contacts/2'},
+                  {'method': 'GET', 'endpoint': 'me'},
+                  'not an operation',
+                  {'method': 'DELETE', 'endpoint': 'me/contacts/3'}]
+
+    summary = graph_session(server).bulk_write(iter(operations),
+                                               report=report)
+
+    assert summary['succeeded'] == 2
+    assert sorted(entry['index'] for entry in summary['failures']) == [
+        1, 2, 3, 4]
+    assert all(entry['error'].startswith('invalid operation')
+               for entry in summary['failures'])
+    assert len(server.requests) == 2
+    with open(report) as fhandle:
+        assert len(fhandle.readlines()) == 6
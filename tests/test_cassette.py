@@ -0,0 +1,142 @@
+"""Tests for recording and replaying GraphSession traffic with a Cassette."""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import gzip
+import json
+import time
+
+import bottle
+import pytest
+
+import graphrest
+
+PHOTO = bytes(range(256)) * 4 # binary, not valid UTF-8
+
+
+def token_server(server):
+    """Configure the test server as a token endpoint and Graph API."""
+    def handler(method, path, body):
+        if path == '/token':
+            return 200, {'Content-Type': 'application/json',
+                         'Set-Cookie': 'session=secret-cookie'}, json.dumps(
+                             {'access_token': 'secret-access-token',
+                              'refresh_token': 'secret-refresh-token',
+                              'id_token': 'secret-id-token',
+                              'scope': 'User.Read', 'expires_in': 3600}
+                         ).encode('utf-8')
+        if path == '/v1.0/me':
+            time.sleep(0.05)
+            return 200, {'Content-Type': 'application/json'}, \
+                b'{"displayName": "Test User"}'
+        if path == '/v1.0/me/photo/$value':
+            return 200, {'Content-Type': 'image/jpeg'}, PHOTO
+        return 404, {}, b'{}'
+    server.handler = handler
+
+
+def graph_session(server_url, cassette, mode, **kwargs):
+    """Return a GraphSession that records to or replays from cassette."""
+    return graphrest.GraphSession(resource=server_url,
+                                  token_endpoint=server_url + 'token',
+                                  cassette=cassette, cassette_mode=mode,
+                                  **kwargs)
+
+
+def run_session(session):
+    """Log in through the redirect handler, then call Graph. Returns the
+    profile data and photo."""
+    bottle.request.bind({'QUERY_STRING': '', 'PATH_INFO': '/login',
+                         'SERVER_NAME': 'localhost', 'SERVER_PORT': '5000',
+                         'wsgi.url_scheme': 'http'})
+    with pytest.raises(bottle.HTTPResponse):
+        session.login()
+    bottle.request.bind({'QUERY_STRING': f'state={session.authstate}&code=abc',
+                         'PATH_INFO': '/login/authorized',
+                         'SERVER_NAME': 'localhost', 'SERVER_PORT': '5000',
+                         'wsgi.url_scheme': 'http'})
+    with pytest.raises(bottle.HTTPResponse):
+        session.redirect_uri_handler()
+    profile = session.get('me').json()
+    photo = b''.join(session.get('me/photo/$value',
+                                 stream=True).iter_content(100))
+    return profile, photo
+
+
+def test_record_replay(server, workdir):
+    """A recorded session replays identically, with no server."""
+    token_server(server)
+    cassette = str(workdir / 'session.cassette')
+
+    recorder = graph_session(server.url, cassette, 'record')
+    recorded = run_session(recorder)
+    recorder.cassette.save()
+    server.stop()
+
+    player = graph_session(server.url, cassette, 'replay')
+    assert run_session(player) == recorded
+    assert recorded == ({'displayName': 'Test User'}, PHOTO)
+    assert player.cassette.calls == recorder.cassette.calls == 3
+    assert player.state['loggedin']
+
+
+def test_tokens_redacted(server, workdir):
+    """Tokens and cookies from the token endpoint aren't saved."""
+    token_server(server)
+    cassette = str(workdir / 'session.cassette')
+
+    recorder = graph_session(server.url, cassette, 'record')
+    run_session(recorder)
+    recorder.cassette.save()
+
+    with gzip.open(cassette, 'rt', encoding='utf-8') as fhandle:
+        saved = fhandle.read()
+    assert 'secret' not in saved
+    assert 'REDACTED_REFRESH_TOKEN' in saved
+
+
+def test_replay_latency(server, workdir):
+    """Replay can reproduce recorded response times, or skip them."""
+    token_server(server)
+    cassette = str(workdir / 'session.cassette')
+    recorder = graph_session(server.url, cassette, 'record')
+    run_session(recorder)
+    recorder.cassette.save()
+
+    for latency in (False, True):
+        player = graph_session(server.url, cassette, 'replay',
+                               cassette_latency=latency)
+        start = time.perf_counter()
+        run_session(player)
+        elapsed = time.perf_counter() - start
+        assert (elapsed >= 0.05) == latency
+
+
+def test_record_streams(server, workdir):
+    """When recording, the body is read after request() returns (so that
+    GraphSession times it as the download phase, as for live calls), and
+    the interaction is saved by record()."""
+    token_server(server)
+    cassette = graphrest.Cassette(str(workdir / 'session.cassette'),
+                                  mode='record')
+
+    response = cassette.request('GET', server.url + 'v1.0/me/photo/$value')
+    assert response.raw.tell() == 0 # body not read yet
+    assert cassette.calls == 0
+    cassette.record(response)
+
+    assert cassette.calls == 1
+    assert response.content == PHOTO
+    assert cassette.interactions[0]['url'].endswith('/v1.0/me/photo/$value')
+
+
+def test_record_timings(server, workdir):
+    """Recorded calls have the same timing breakdown as live calls."""
+    token_server(server)
+    recorder = graph_session(server.url, str(workdir / 'session.cassette'),
+                             'record', refresh_enable=False)
+
+    response = recorder.get('me/photo/$value')
+
+    assert response.content == PHOTO
+    assert response.timings['ttfb'] > 0
+    assert response.timings['download'] > 0
@@ -0,0 +1,138 @@
+"""Tests for CallTimer, SamplingProfiler and graphprofile."""
+# Copyright (c) Microsoft. All rights reserved. Licensed under the MIT license.
+# See LICENSE in the project root for license information.
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import graphprofile
+import graphrest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def graph_session(server, **kwargs):
+    """Return a GraphSession that sends Graph calls to the test server."""
+    return graphrest.GraphSession(resource=server.url, refresh_enable=False,
+                                  **kwargs)
+
+
+def slow_handler(method, path, body):
+    """Respond after a delay, so that sampled calls collect samples."""
+    time.sleep(0.02)
+    return 200, {'Content-Type': 'application/json'}, b'{"value": [1, 2, 3]}'
+
+
+def test_timings(server):
+    """Responses carry every phase; connect is only measured for a new
+    connection, and decode only once json() is called."""
+    session = graph_session(server)
+
+    first = session.get('me')
+    assert set(first.timings) == set(graphrest.CallTimer.PHASES) | {'total'}
+    assert first.timings['connect'] > 0
+    assert first.timings['decode'] == 0
+    assert first.json() == {}
+    assert first.timings['decode'] > 0
+
+    second = session.get('me')
+    assert second.timings['connect'] == 0
+    assert all(seconds >= 0 for seconds in second.timings.values())
+
+
+@pytest.mark.parametrize('path, template', [
+    ('/v1.0/me', '/v1.0/me'),
+    ('/v1.0/groups/0f8fad5b-d9cb-469f-a165-70867728950e/members',
+     '/v1.0/groups/{id}/members'),
+    ('/v1.0/users/someone@contoso.com/messages', '/v1.0/users/{id}/messages'),
+    ('/v1.0/me/contacts/AAMkAGI2TG93AAA=', '/v1.0/me/contacts/{id}'),
+    ("/v1.0/me/contacts('x')", '/v1.0/me/contacts({id})'),
+    ('/v1.0/me/events/42', '/v1.0/me/events/{id}'),
+    ('/v1.0/users/delta()', '/v1.0/users/delta()'),
+    ('/v1.0/me/mailFolders/inbox', '/v1.0/me/mailFolders/inbox'),
+])
+def test_endpoint_template(path, template):
+    """Resource IDs in URL paths are replaced with {id}."""
+    assert graphrest.endpoint_template(path) == template
+
+
+@pytest.mark.parametrize('rate', [0.0, 1.0])
+def test_sampling_rate(server, rate):
+    """rate=0 samples no calls and rate=1 samples every call, including
+    token validation and header building; timings are always aggregated
+    per endpoint template."""
+    server.handler = slow_handler
+    profiler = graphrest.SamplingProfiler(rate=rate)
+    session = graph_session(server, profiler=profiler)
+
+    for contact in range(3):
+        session.patch(f'me/contacts/{contact}', data='{}')
+
+    stats = profiler.report()['PATCH /v1.0/me/contacts/{id}']
+    assert stats['calls'] == 3
+    assert stats['timings']['total'] > 0.06
+    if rate:
+        assert stats['sampled_calls'] == 3
+        assert stats['samples'] > 0
+        assert any(name.startswith('patch (graphrest.py')
+                   for name in stats['frames'])
+    else:
+        assert stats['sampled_calls'] == stats['samples'] == 0
+
+
+def test_failed_calls_stop_sampling():
+    """Sampler threads are stopped when a call fails before its request."""
+    profiler = graphrest.SamplingProfiler(rate=1.0)
+    session = graphrest.GraphSession(profiler=profiler,
+                                     token_endpoint='http://127.0.0.1:9/t')
+    for _ in range(5):
+        with pytest.raises(Exception):
+            session.get('me')
+
+    assert not [thread for thread in threading.enumerate()
+                if isinstance(thread, graphrest.StackSampler)]
+    assert profiler.report()['GET /v1.0/me']['sampled_calls'] == 5
+
+
+def test_save_and_cli(server, workdir):
+    """A saved aggregate round-trips through JSON and is printed by the
+    graphprofile command line, which doesn't need config.py."""
+    server.handler = slow_handler
+    profiler = graphrest.SamplingProfiler(rate=1.0)
+    session = graph_session(server, profiler=profiler)
+    session.get('me/messages').json()
+    filename = str(workdir / 'profile.json')
+
+    profiler.save(filename)
+    with open(filename) as fhandle:
+        assert json.load(fhandle) == json.loads(json.dumps(profiler.report()))
+
+    output = subprocess.run(
+        [sys.executable, os.path.join(REPO, 'graphprofile.py'), filename,
+         '--top', '3'], capture_output=True, text=True, check=True).stdout
+    assert output.startswith('GET /v1.0/me/messages  calls=1 sampled=1')
+    assert 'hot frames' in output
+    assert len([line for line in output.splitlines()
+                if line.startswith('    ')]) == 3
+
+
+def test_print_profile(capsys):
+    """print_profile() lists endpoints slowest first, with average timings."""
+    report = {
+        'GET /v1.0/me': {'calls': 2, 'sampled_calls': 0, 'samples': 0,
+                         'timings': {'ttfb': 0.02, 'total': 0.04},
+                         'frames': {}, 'leaves': {}},
+        'POST /v1.0/me/contacts': {'calls': 1, 'sampled_calls': 0,
+                                   'samples': 0, 'timings': {'total': 0.5},
+                                   'frames': {}, 'leaves': {}}}
+
+    graphprofile.print_profile(report)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('POST /v1.0/me/contacts')
+    assert 'ttfb=10.0ms' in lines[4] and 'total=20.0ms' in lines[4]